@@ -1,21 +1,34 @@
-import subprocess, tempfile, os, re, textwrap
+import subprocess, tempfile, os, re, textwrap, hashlib, functools, asyncio, multiprocessing, signal
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import asynccontextmanager
+from asn1crypto import cms, core, pem
+from cryptography.exceptions import InvalidSignature
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import ec, padding, rsa
+from cryptography.x509 import load_der_x509_certificate
 from fastapi import FastAPI, UploadFile, File, Form, HTTPException
-from fastapi.responses import StreamingResponse, JSONResponse, HTMLResponse
-from pypdf import PdfReader, PdfWriter
-from reportlab.pdfgen import canvas
+from fastapi.responses import FileResponse, JSONResponse, HTMLResponse
+from starlette.background import BackgroundTask
+import pikepdf
 from reportlab.lib.units import mm
 from reportlab.pdfbase import pdfmetrics
-from reportlab.pdfbase.ttfonts import TTFont
+from reportlab.pdfbase.ttfonts import TTFont, makeToUnicodeCMap
 from reportlab.lib.colors import Color
-from io import BytesIO
 from datetime import datetime
 from zoneinfo import ZoneInfo
 
-app = FastAPI(title="PDF Sign Stamp (SIG → visual)")
-
 # ---- настройки ----
 STAMP_BLUE = Color(0/255, 70/255, 173/255)  # синий «печать»
 STAMP_TZ = os.environ.get("STAMP_TZ", "Europe/Moscow")
+try:
+    _LOCAL_TZ = ZoneInfo(STAMP_TZ)
+except Exception:
+    _LOCAL_TZ = None   # неизвестная зона — время выводим в UTC
+# процессы для CPU-работы (разбор подписи, pikepdf, ReportLab) — отдельный пул на каждый
+# uvicorn-воркер. os.cpu_count() в контейнере — ядра хоста, а каждый процесс пула ~40-50 МБ,
+# поэтому по умолчанию не больше 2 (см. mem_limit в docker-compose.yml)
+STAMP_WORKERS = int(os.environ.get("STAMP_WORKERS", min(len(os.sched_getaffinity(0)), 2)))
 
 # ---- шрифт ----
 try:
@@ -23,98 +36,258 @@ try:
     FONT_NAME = "DejaVuSans"
 except Exception:
     FONT_NAME = "Helvetica"
+# метрики и подмножества TTF берём у ReportLab; None — стандартная Helvetica без встраивания
+_FACE = getattr(pdfmetrics.getFont(FONT_NAME), "face", None) if FONT_NAME != "Helvetica" else None
+
+# ширины глифов {кодпоинт: ширина при 1000 ед.} — без обхода pdfmetrics на каждый символ
+if _FACE is not None:
+    _WIDTHS, _DEFAULT_WIDTH = _FACE.charWidths, _FACE.defaultWidth
+else:
+    _WIDTHS = {ord(bytes([code]).decode("cp1252", errors="replace")): wd
+               for code, wd in enumerate(pdfmetrics.getFont(FONT_NAME).widths)}
+    _DEFAULT_WIDTH = _WIDTHS[ord("?")]
+
+def _str_width(s: str, size: float) -> float:
+    get = _WIDTHS.get
+    return sum(get(ord(ch), _DEFAULT_WIDTH) for ch in s) * size / 1000.0
+
+# ---- пул процессов ----
+_EXEC: ProcessPoolExecutor | None = None
+
+def _executor() -> ProcessPoolExecutor:
+    global _EXEC
+    if _EXEC is None:
+        # forkserver: процессы пула не форкаются от uvicorn, в котором уже работают потоки;
+        # SIGINT игнорируют — пул останавливает lifespan при завершении приложения
+        _EXEC = ProcessPoolExecutor(max_workers=STAMP_WORKERS,
+                                    mp_context=multiprocessing.get_context("forkserver"),
+                                    initializer=signal.signal, initargs=(signal.SIGINT, signal.SIG_IGN))
+    return _EXEC
+
+async def _in_pool(fn, *args):
+    global _EXEC
+    pool = _executor()
+    try:
+        return await asyncio.get_running_loop().run_in_executor(pool, fn, *args)
+    except BrokenProcessPool:
+        # процесс пула убит (например, OOM-killer): сломанный пул больше не принимает задач,
+        # поэтому создаём новый для следующих запросов, а этот отвечаем 503
+        if _EXEC is pool:
+            _EXEC = None
+            pool.shutdown(wait=False, cancel_futures=True)
+        raise HTTPException(503, "worker process died, please retry")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    yield
+    if _EXEC is not None:
+        _EXEC.shutdown(cancel_futures=True)
+
+app = FastAPI(title="PDF Sign Stamp (SIG → visual)", lifespan=lifespan)
 
 # ---- утилиты ----
-def run(cmd, input_bytes=None):
-    p = subprocess.run(cmd, input=input_bytes, capture_output=True, check=False)
+def run(cmd, input_bytes=None, stdout_devnull=False):
+    p = subprocess.run(cmd, input=input_bytes, check=False,
+                       stdout=subprocess.DEVNULL if stdout_devnull else subprocess.PIPE,
+                       stderr=subprocess.PIPE)
     out = (p.stdout or b"").decode(errors="ignore")
     err = (p.stderr or b"").decode(errors="ignore")
     return p.returncode, out, err
 
+_RE_FIO = re.compile(
+    r"CN\s*=\s*(?P<cn>[^,+/]+)|"
+    r"SURNAME\s*=\s*(?P<sn>[^,+/]+)|"
+    r"(?:GIVENNAME|G)\s*=\s*(?P<gn>[^,+/]+)|"
+    r"\bSN\s*=\s*(?P<sn2>[^,+/]+)"
+)
+
 def _extract_fio_from_subject(subj: str):
-    m = re.search(r"CN\s*=\s*([^,+/]+)", subj)
-    if m and m.group(1).strip():
-        return m.group(1).strip()
-    sn = re.search(r"SURNAME\s*=\s*([^,+/]+)", subj)
-    gn = re.search(r"(?:GIVENNAME|G)\s*=\s*([^,+/]+)", subj)
-    if sn or gn:
-        return " ".join([x.group(1).strip() for x in [sn, gn] if x]).strip() or None
-    m = re.search(r"SN\s*=\s*([^,+/]+)", subj)
-    if m and m.group(1).strip():
-        return m.group(1).strip()
-    return None
+    """CN, иначе «SURNAME GIVENNAME», иначе SN — за один проход по subject."""
+    found = {}
+    for m in _RE_FIO.finditer(subj):
+        key = m.lastgroup
+        value = m.group(key).strip()
+        if value and key not in found:
+            found[key] = value
+    if "cn" in found:
+        return found["cn"]
+    if "sn" in found or "gn" in found:
+        return " ".join(found[k] for k in ("sn", "gn") if k in found)
+    return found.get("sn2")
 
 def _fmt_local(dt_utc: datetime) -> str:
+    if _LOCAL_TZ is None:
+        return dt_utc.strftime("%d.%m.%Y %H:%M")
     try:
-        tz = ZoneInfo(STAMP_TZ)
-        return dt_utc.astimezone(tz).strftime("%d.%m.%Y %H:%M")
+        return dt_utc.astimezone(_LOCAL_TZ).strftime("%d.%m.%Y %H:%M")
     except Exception:
         return dt_utc.strftime("%d.%m.%Y %H:%M")
 
-def _parse_signing_time_pretty(s: str | None) -> str | None:
-    if not s:
-        return None
-    s = s.strip()
+# OpenSSL 3.0-имена атрибутов DN (как в `openssl x509 -nameopt ...`);
+# OID, которых нет в таблице, openssl тоже печатает в точечной записи
+_DN_SHORT = {
+    "2.5.4.3": "CN", "2.5.4.4": "SN", "2.5.4.42": "GN", "2.5.4.43": "initials",
+    "2.5.4.12": "title", "2.5.4.6": "C", "2.5.4.8": "ST", "2.5.4.7": "L",
+    "2.5.4.9": "street", "2.5.4.10": "O", "2.5.4.11": "OU", "2.5.4.5": "serialNumber",
+    "2.5.4.13": "description", "2.5.4.14": "searchGuide", "2.5.4.15": "businessCategory",
+    "2.5.4.16": "postalAddress", "2.5.4.17": "postalCode", "2.5.4.18": "postOfficeBox",
+    "2.5.4.20": "telephoneNumber", "2.5.4.41": "name", "2.5.4.44": "generationQualifier",
+    "2.5.4.45": "x500UniqueIdentifier", "2.5.4.46": "dnQualifier", "2.5.4.51": "houseIdentifier",
+    "2.5.4.54": "dmdName", "2.5.4.65": "pseudonym", "2.5.4.97": "organizationIdentifier",
+    "1.2.840.113549.1.9.1": "emailAddress", "1.2.840.113549.1.9.2": "unstructuredName",
+    "1.2.840.113549.1.9.8": "unstructuredAddress",
+    "0.9.2342.19200300.100.1.1": "UID", "0.9.2342.19200300.100.1.25": "DC",
+    "1.3.6.1.4.1.311.60.2.1.1": "jurisdictionL", "1.3.6.1.4.1.311.60.2.1.2": "jurisdictionST",
+    "1.3.6.1.4.1.311.60.2.1.3": "jurisdictionC",
+    "1.2.643.3.131.1.1": "INN", "1.2.643.100.1": "OGRN", "1.2.643.100.3": "SNILS",
+    "1.2.643.100.5": "OGRNIP", "1.2.643.100.111": "subjectSignTool", "1.2.643.100.112": "issuerSignTool",
+}
+
+def _dn_value(atv) -> str:
+    try:
+        return atv["value"].native
+    except ValueError:
+        # тип строки не тот, что в схеме asn1crypto (напр. telephoneNumber в UTF8String);
+        # openssl печатает значение как есть — разбираем по собственному тегу
+        return core.load(atv.dump())[1].native
+
+def _fmt_name(name) -> str:
+    """x509.Name → 'C = RU,O = ...,CN = ...' (формат utf8,sep_comma_plus,space_eq)."""
+    rdns = []
+    for rdn in name.chosen:
+        rdns.append("+".join(
+            f"{_DN_SHORT.get(a['type'].dotted, a['type'].dotted)} = {_dn_value(a)}" for a in rdn
+        ))
+    return ",".join(rdns)
+
+def _fmt_asn1_time(dt: datetime) -> str:
+    """Как `openssl x509 -startdate`: 'Jan  2 03:04:05 2024 GMT'."""
+    return f"{dt:%b} {dt.day:2d} {dt:%H:%M:%S %Y} GMT"
+
+def _fmt_serial(n: int) -> str:
+    h = format(n, "X")
+    return h.zfill(len(h) + len(h) % 2)
+
+def _detect_fmt(sig_bytes: bytes) -> str:
+    """Формат подписи для openssl -inform: PEM, если в файле есть armor-заголовок."""
+    return "PEM" if b"-----BEGIN" in sig_bytes else "DER"
+
+def _load_signed_data(sig_bytes: bytes, fmt: str):
+    """DER или PEM → (SignedData, первый SignerInfo); (None, None), если это не CMS/PKCS#7."""
     try:
-        dt = datetime.strptime(s, "%b %d %H:%M:%S %Y %Z").replace(tzinfo=ZoneInfo("UTC"))
-        return _fmt_local(dt)
+        if fmt == "PEM":
+            # BOM и текст перед заголовком openssl пропускает — разбираем с заголовка
+            _, _, sig_bytes = pem.unarmor(sig_bytes[sig_bytes.index(b"-----BEGIN"):])
+        ci = cms.ContentInfo.load(sig_bytes)
+        if ci["content_type"].native != "signed_data":
+            return None, None
+        signed_data = ci["content"]
+        return signed_data, signed_data["signer_infos"][0]
     except Exception:
-        pass
-    for fmt in ("%b %d %H:%M:%S %Y", "%Y-%m-%d %H:%M:%S %Z", "%Y-%m-%d %H:%M:%S",
-                "%d.%m.%Y %H:%M:%S", "%d.%m.%Y %H:%M"):
-        try:
-            dt = datetime.strptime(s, fmt).replace(tzinfo=ZoneInfo("UTC"))
-            return _fmt_local(dt)
-        except Exception:
-            continue
-    m = re.search(r"(\d{4})[-.](\d{2})[-.](\d{2}).*?(\d{2}):(\d{2})", s)
-    if m:
-        y, mo, d, h, mi = map(int, m.groups())
+        return None, None
+
+def _signed_attr(signer_info, name: str):
+    attrs = signer_info["signed_attrs"]
+    if not isinstance(attrs, cms.CMSAttributes):
+        return None
+    for attr in attrs:
+        if attr["type"].native == name:
+            return attr["values"][0]
+    return None
+
+def _find_signer_cert(signed_data, signer_info, fallback=True):
+    """Сертификат подписанта по sid; если не нашли — первый сертификат из подписи (при fallback)."""
+    if not isinstance(signed_data["certificates"], cms.CertificateSet):
+        return None
+    certs = [c.chosen for c in signed_data["certificates"] if c.name == "certificate"]
+    sid = signer_info["sid"]
+    for cert in certs:
+        if sid.name == "issuer_and_serial_number":
+            if cert.issuer == sid.chosen["issuer"] and cert.serial_number == sid.chosen["serial_number"].native:
+                return cert
+        elif cert.key_identifier == sid.native:
+            return cert
+    return certs[0] if certs and fallback else None
+
+def _cert_fields(cert) -> dict:
+    """Поля сертификата для ответа; поле, которое не разбирается, остаётся None."""
+    getters = {
+        "subject": lambda: _fmt_name(cert.subject),
+        "issuer": lambda: _fmt_name(cert.issuer),
+        "serial": lambda: _fmt_serial(cert.serial_number),
+        "notBefore": lambda: _fmt_asn1_time(cert.not_valid_before),
+        "notAfter": lambda: _fmt_asn1_time(cert.not_valid_after),
+    }
+    fields = {}
+    for key, get in getters.items():
         try:
-            dt = datetime(y, mo, d, h, mi, tzinfo=ZoneInfo("UTC"))
-            return _fmt_local(dt)
+            fields[key] = get()
         except Exception:
-            pass
-    return None
+            fields[key] = None
+    return fields
+
+# только хэши фиксированной длины; ГОСТ, SHAKE и прочее проверяет openssl
+_HASHES = {
+    "sha1": hashes.SHA1, "sha224": hashes.SHA224, "sha256": hashes.SHA256,
+    "sha384": hashes.SHA384, "sha512": hashes.SHA512,
+    "sha3_224": hashes.SHA3_224, "sha3_256": hashes.SHA3_256,
+    "sha3_384": hashes.SHA3_384, "sha3_512": hashes.SHA3_512,
+}
+
+def _verify_in_process(pdf_path: str, signed_data, signer_info) -> bool | None:
+    """То же, что `openssl cms -verify -noverify` (цепочку не проверяем, подпись — да).
+
+    Хэш PDF сверяется с messageDigest (быстрый отказ), затем подпись над signedAttrs
+    проверяется открытым ключом сертификата подписанта (RSA PKCS#1 v1.5 / ECDSA).
+    None — случай не поддерживается (ГОСТ, RSA-PSS, нет signedAttrs) или SignedData
+    не разбирается целиком (asn1crypto парсит лениво) — решает openssl.
+    """
+    try:
+        # полный разбор: структуру, которую openssl не декодирует, отдаём ему же
+        signed_data.native
+        digest_name = signer_info["digest_algorithm"]["algorithm"].native
+        expected = _signed_attr(signer_info, "message_digest")
+        if digest_name not in _HASHES or expected is None:
+            return None
+        sig_algo = signer_info["signature_algorithm"].signature_algo
+        if sig_algo not in ("rsassa_pkcs1v15", "ecdsa"):
+            return None
+        expected = expected.native
+        content_type = _signed_attr(signer_info, "content_type")
+        content_type = content_type.native if content_type is not None else None
+        encap_type = signed_data["encap_content_info"]["content_type"].native
+        cert = _find_signer_cert(signed_data, signer_info, fallback=False)
+        # signedAttrs подписываются в DER как SET OF (тег 0x31), а не как [0] IMPLICIT
+        data = b"\x31" + signer_info["signed_attrs"].dump()[1:]
+        signature = signer_info["signature"].native
+    except Exception:
+        return None
 
-def _parse_signing_time_from_cms_print(sig_path: str) -> str | None:
-    """Ищем блок 'object: signingTime' и читаем UTCTIME/GENERALIZEDTIME рядом."""
-    for fmt in ("DER", "PEM"):
-        rc, out, err = run(["openssl", "cms", "-cmsout", "-print", "-inform", fmt, "-in", sig_path])
-        if rc != 0:
-            continue
-        lines = out.splitlines()
-        for i, line in enumerate(lines):
-            if re.search(r"\bobject:\s*signingTime\b", line, re.IGNORECASE):
-                tail = "\n".join(lines[i:i+8])
-                m = re.search(r"GENERALIZEDTIME\s*:\s*([0-9]{14}Z)", tail)
-                if m:
-                    dt = datetime.strptime(m.group(1), "%Y%m%d%H%M%SZ").replace(tzinfo=ZoneInfo("UTC"))
-                    return _fmt_local(dt)
-                m = re.search(r"UTCTIME\s*:\s*([0-9]{12}Z)", tail)
-                if m:
-                    dt = datetime.strptime(m.group(1), "%y%m%d%H%M%SZ").replace(tzinfo=ZoneInfo("UTC"))
-                    return _fmt_local(dt)
-                m = re.search(r"UTCTIME\s*:\s*([A-Za-z]{3}\s+\d{1,2}\s+\d{2}:\d{2}:\d{2}\s+\d{4}\s+GMT)", tail)
-                if m:
-                    return _parse_signing_time_pretty(m.group(1))
-    return None
+    h = hashlib.new(digest_name)
+    with open(pdf_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    if h.digest() != expected:
+        return False
+    if content_type is None or content_type != encap_type:
+        return False
+    if cert is None:
+        return False
 
-def _parse_signing_time_from_asn1(sig_path: str) -> str | None:
-    """Разбор `openssl asn1parse` (учитываем пробелы перед двоеточием)."""
-    for fmt in ("DER", "PEM"):
-        rc, out, err = run(["openssl", "asn1parse", "-inform", fmt, "-in", sig_path])
-        if rc != 0:
-            continue
-        m = re.search(r"GENERALIZEDTIME\s*:\s*([0-9]{14}Z)", out)
-        if m:
-            dt = datetime.strptime(m.group(1), "%Y%m%d%H%M%SZ").replace(tzinfo=ZoneInfo("UTC"))
-            return _fmt_local(dt)
-        m = re.search(r"UTCTIME\s*:\s*([0-9]{12}Z)", out)
-        if m:
-            dt = datetime.strptime(m.group(1), "%y%m%d%H%M%SZ").replace(tzinfo=ZoneInfo("UTC"))
-            return _fmt_local(dt)
-    return None
+    try:
+        key = load_der_x509_certificate(cert.dump()).public_key()
+        if sig_algo == "rsassa_pkcs1v15" and isinstance(key, rsa.RSAPublicKey):
+            key.verify(signature, data, padding.PKCS1v15(), _HASHES[digest_name]())
+        elif sig_algo == "ecdsa" and isinstance(key, ec.EllipticCurvePublicKey):
+            key.verify(signature, data, ec.ECDSA(_HASHES[digest_name]()))
+        else:
+            return False
+    except InvalidSignature:
+        return False
+    except Exception:
+        # битый сертификат или ключ — openssl такую подпись тоже не примет
+        return False
+    return True
 
 # ---- основная логика ----
 def try_verify_and_extract(pdf_path, sig_path):
@@ -131,76 +304,58 @@ def try_verify_and_extract(pdf_path, sig_path):
     }
 
     with open(sig_path, "rb") as f:
-        head = f.read(256)
-    head_txt = head.decode(errors="ignore")
+        sig_bytes = f.read()
+    head_txt = sig_bytes[:256].decode(errors="ignore")
     is_pgp = "BEGIN PGP SIGNATURE" in head_txt
     info["format"] = "pgp" if is_pgp else "cms"
     if is_pgp:
         return info
 
+    fmt = _detect_fmt(sig_bytes)
+    signed_data, signer_info = _load_signed_data(sig_bytes, fmt)
+    if signed_data is None:
+        other = "PEM" if fmt == "DER" else "DER"
+        signed_data, signer_info = _load_signed_data(sig_bytes, other)
+        if signed_data is not None:
+            fmt = other
+
     # соответствие подписи контенту
-    for fmt in ("DER", "PEM"):
-        rc, out, err = run([
-            "openssl", "cms", "-verify", "-noverify",
-            "-inform", fmt, "-in", sig_path,
-            "-content", pdf_path, "-out", os.devnull
-        ])
-        if rc == 0:
-            info["matched"] = True
-            break
-
-    # signingTime
-    st = _parse_signing_time_from_cms_print(sig_path)
-    if not st:
-        for fmt in ("DER", "PEM"):
-            rc, out, err = run(["openssl", "cms", "-cmsout", "-print", "-inform", fmt, "-in", sig_path])
-            if rc == 0 and ("signingTime" in out or "Signing Time" in out):
-                m = re.search(r"(?:signingTime|Signing Time)\s*:\s*(.+)", out)
-                if m:
-                    st = _parse_signing_time_pretty(m.group(1).strip())
-                    if st:
-                        break
-    if not st:
-        st = _parse_signing_time_from_asn1(sig_path)
-    info["signingTime"] = st or "—"
-
-    # первый сертификат из подписи
-    certs_pem = None
-    for fmt in ("DER", "PEM"):
-        rc, out, err = run(["openssl", "pkcs7", "-inform", fmt, "-in", sig_path, "-print_certs"])
-        if rc == 0 and "BEGIN CERTIFICATE" in out:
-            certs_pem = out
-            break
-    signer_pem = None
-    if certs_pem:
-        parts = certs_pem.split("-----END CERTIFICATE-----")
-        signer_pem = parts[0] + "-----END CERTIFICATE-----"
-
-    if signer_pem:
-        with tempfile.NamedTemporaryFile("w+", delete=False, suffix=".pem") as f:
-            f.write(signer_pem); signer_path = f.name
-        try:
+    matched = _verify_in_process(pdf_path, signed_data, signer_info) if signed_data is not None else None
+    if matched is None:
+        # ГОСТ, RSA-PSS, подпись без signedAttrs или не разобранная asn1crypto —
+        # проверяем через openssl (+ gost engine); второй формат — если угаданный не подошёл
+        for inform in (fmt, "PEM" if fmt == "DER" else "DER"):
+            # -binary: PDF сверяем как есть, без S/MIME-канонизации переводов строк;
+            # восстановленный контент уходит в stdout и сразу отбрасывается
             rc, out, err = run([
-                "openssl", "x509", "-in", signer_path, "-noout",
-                "-subject", "-issuer", "-serial", "-startdate", "-enddate",
-                "-nameopt", "utf8,sep_comma_plus,space_eq"
-            ])
+                "openssl", "cms", "-verify", "-noverify", "-binary",
+                "-inform", inform, "-in", sig_path,
+                "-content", pdf_path
+            ], stdout_devnull=True)
             if rc == 0:
-                for line in out.splitlines():
-                    if line.startswith("subject="):
-                        subj = line.split("subject=", 1)[1].strip()
-                        info["subject"] = subj
-                        info["cn"] = _extract_fio_from_subject(subj)
-                    elif line.startswith("issuer="):
-                        info["issuer"] = line.split("issuer=", 1)[1].strip()
-                    elif line.startswith("serial="):
-                        info["serial"] = line.split("serial=", 1)[1].strip()
-                    elif line.startswith("notBefore="):
-                        info["notBefore"] = line.split("notBefore=", 1)[1].strip()
-                    elif line.startswith("notAfter="):
-                        info["notAfter"] = line.split("notAfter=", 1)[1].strip()
-        finally:
-            os.unlink(signer_path)
+                matched = True
+                break
+    info["matched"] = bool(matched)
+    if signed_data is None:
+        info["signingTime"] = "—"
+        return info
+
+    # signingTime (битый атрибут — как отсутствующий)
+    try:
+        st = _signed_attr(signer_info, "signing_time")
+        info["signingTime"] = _fmt_local(st.native) if st is not None else "—"
+    except Exception:
+        info["signingTime"] = "—"
+
+    # сертификат подписанта
+    try:
+        cert = _find_signer_cert(signed_data, signer_info)
+    except Exception:
+        cert = None
+    if cert is not None:
+        info.update(_cert_fields(cert))
+        if info["subject"]:
+            info["cn"] = _extract_fio_from_subject(info["subject"])
 
     return info
 
@@ -216,92 +371,225 @@ def build_stamp_lines(info: dict) -> list[tuple[str, str]]:
         (f"Дата подписания: {when}", "data"),
     ]
 
-def overlay_stamp(pdf_bytes: bytes, lines: list[tuple[str,str]], pages="last", box_height_mm=28, font_size=9) -> bytes:
-    reader = PdfReader(BytesIO(pdf_bytes))
-    writer = PdfWriter()
-
-    for i, page in enumerate(reader.pages):
-        if pages == "first" and i != 0:
-            writer.add_page(page); continue
-        if pages == "last" and i != len(reader.pages) - 1:
-            writer.add_page(page); continue
-
-        w = float(page.mediabox.width)
-        h = float(page.mediabox.height)
-
-        buf = BytesIO()
-        c = canvas.Canvas(buf, pagesize=(w, h))
-        margin = 12 * mm
-
-        # шире общий блок: 50% полезной ширины
-        box_w = (w - 2 * margin) * 0.50
-        box_h = box_height_mm * mm
-        x = w - margin - box_w
-        y = margin
-
-        c.setStrokeColor(STAMP_BLUE)
-        c.setFillColor(STAMP_BLUE)
-        c.roundRect(x, y, box_w, box_h, 3 * mm, stroke=1, fill=0)
-
-        # размеры шрифта
-        size_title   = max(10, font_size + 1)
-        size_ribbon  = font_size
-        size_data    = max(6, font_size - 1)
-
-        side_pad = 3 * mm
-        top_pad  = 3 * mm
-        line_gap = 1
-
-        # 1) Заголовок по центру
-        title = next(t for t,k in lines if k == "title")
-        c.setFont(FONT_NAME, size_title)
-        title_w = c.stringWidth(title, FONT_NAME, size_title)
-        c.drawString(x + (box_w - title_w) / 2.0, y + box_h - top_pad - size_title, title)
-
-        # 2) Узкая внутренняя лента (ещё уже)
-        ribbon_text = next(t for t,k in lines if k == "ribbon")
-        ribbon_h = 7 * mm
-        inner_margin = 9 * mm      # БЫЛО 6 мм -> стало уже
-        ribbon_y_top = y + box_h - top_pad - size_title - 2*mm
-        inner_x = x + inner_margin
-        inner_w = box_w - 2 * inner_margin
-        inner_y = ribbon_y_top - ribbon_h
-        c.roundRect(inner_x, inner_y, inner_w, ribbon_h, 2 * mm, stroke=1, fill=0)
-
-        # текст в ленте — по центру
-        c.setFont(FONT_NAME, size_ribbon)
-        tw = c.stringWidth(ribbon_text, FONT_NAME, size_ribbon)
-        text_x = inner_x + (inner_w - tw) / 2.0
-        text_y = inner_y + (ribbon_h - size_ribbon) / 2.0 + 0.7*mm
-        c.drawString(text_x, text_y, ribbon_text)
-
-        # 3) Данные — ниже ленты
-        ty = inner_y - 2*mm - size_data
-        c.setFont(FONT_NAME, size_data)
-
-        avg_char_w = 0.52 * size_data
-        max_chars = max(16, int((inner_w) / avg_char_w))
-        for text, kind in lines:
-            if kind != "data":
-                continue
-            for wrapped in (textwrap.wrap(text, width=max_chars) or [" "]):
-                c.drawString(inner_x, ty, wrapped)
-                ty -= (size_data + line_gap)
-                if ty < y + 3 * mm:
-                    break
-
-        c.save()
-        buf.seek(0)
-        overlay_page = PdfReader(buf).pages[0]
-        page.merge_page(overlay_page)
-        writer.add_page(page)
-
-    out = BytesIO()
-    writer.write(out)
-    out.seek(0)
-    return out.read()
+# ---- штамп: content stream без ReportLab canvas ----
+def _num(v: float) -> str:
+    return f"{v:.2f}"
+
+def _round_rect_ops(x, y, w, h, r) -> str:
+    """Скруглённый прямоугольник (обводка) — те же кривые, что у canvas.roundRect."""
+    t = 0.4472 * r
+    x1, y1 = x + w, y + h
+    pts = [
+        (x + r, y, "m"), (x1 - r, y, "l"), (x1 - r + t, y, x1, y + r - t, x1, y + r, "c"),
+        (x1, y1 - r, "l"), (x1, y1 - r + t, x1 - r + t, y1, x1 - r, y1, "c"),
+        (x + r, y1, "l"), (x + r - t, y1, x, y1 - r + t, x, y1 - r, "c"),
+        (x, y + r, "l"), (x, y + r - t, x + r - t, y, x + r, y, "c"),
+    ]
+    return "\n".join(" ".join(_num(v) for v in p[:-1]) + " " + p[-1] for p in pts) + "\nh S"
+
+def _encode_runs(texts) -> tuple[tuple, list]:
+    """Кодируем строки для однобайтовых подмножеств TTF-шрифта (как ReportLab: код 0 — .notdef).
+
+    Возвращает (подмножества — кортежи кодпоинтов, [[(номер подмножества, bytes), ...] на строку]).
+    Для Helvetica (нет DejaVuSans) — одно «подмножество» и WinAnsi.
+    """
+    if _FACE is None:
+        return ((),), [[(0, t.encode("cp1252", errors="replace"))] for t in texts]
+    subsets, assigned, encoded = [], {}, []
+    for text in texts:
+        runs = []
+        for ch in map(ord, text):
+            if ch == 0xa0:
+                ch = 32
+            if ch not in _FACE.charToGlyph:
+                ch = 0
+            if ch not in assigned:
+                if not subsets or len(subsets[-1]) == 256:
+                    subsets.append([0])
+                    assigned.setdefault(0, (len(subsets) - 1, 0))
+                if ch not in assigned:
+                    assigned[ch] = (len(subsets) - 1, len(subsets[-1]))
+                    subsets[-1].append(ch)
+            n, code = assigned[ch]
+            if runs and runs[-1][0] == n:
+                runs[-1][1].append(code)
+            else:
+                runs.append((n, [code]))
+        encoded.append([(n, bytes(codes)) for n, codes in runs])
+    return tuple(tuple(s) for s in subsets), encoded
+
+def _text_ops(x, y, size, runs) -> str:
+    ops = [f"BT {_num(x)} {_num(y)} Td"]
+    for n, data in runs:
+        ops.append(f"/F{n} {_num(size)} Tf <{data.hex()}> Tj")
+    ops.append("ET")
+    return " ".join(ops)
+
+@functools.lru_cache(maxsize=256)
+def _render_overlay(w: float, lines: tuple, box_height_mm, font_size) -> tuple[bytes, tuple]:
+    """Content stream штампа в правом нижнем углу страницы шириной w + нужные подмножества шрифта.
+
+    Кэшируется: при пакетной подписи одним сертификатом геометрия и строки совпадают.
+    """
+    margin = 12 * mm
+
+    # шире общий блок: 50% полезной ширины
+    box_w = (w - 2 * margin) * 0.50
+    box_h = box_height_mm * mm
+    x = w - margin - box_w
+    y = margin
+
+    r, g, b = STAMP_BLUE.rgb()
+    ops = ["q", f"{r:.4f} {g:.4f} {b:.4f} RG {r:.4f} {g:.4f} {b:.4f} rg",
+           _round_rect_ops(x, y, box_w, box_h, 3 * mm)]
+    texts = []   # (x, y, size, text)
+
+    # размеры шрифта
+    size_title   = max(10, font_size + 1)
+    size_ribbon  = font_size
+    size_data    = max(6, font_size - 1)
+
+    side_pad = 3 * mm
+    top_pad  = 3 * mm
+    line_gap = 1
+
+    # 1) Заголовок по центру
+    title = next(t for t,k in lines if k == "title")
+    title_w = _str_width(title, size_title)
+    texts.append((x + (box_w - title_w) / 2.0, y + box_h - top_pad - size_title, size_title, title))
+
+    # 2) Узкая внутренняя лента (ещё уже)
+    ribbon_text = next(t for t,k in lines if k == "ribbon")
+    ribbon_h = 7 * mm
+    inner_margin = 9 * mm      # БЫЛО 6 мм -> стало уже
+    ribbon_y_top = y + box_h - top_pad - size_title - 2*mm
+    inner_x = x + inner_margin
+    inner_w = box_w - 2 * inner_margin
+    inner_y = ribbon_y_top - ribbon_h
+    ops.append(_round_rect_ops(inner_x, inner_y, inner_w, ribbon_h, 2 * mm))
+
+    # текст в ленте — по центру
+    tw = _str_width(ribbon_text, size_ribbon)
+    text_x = inner_x + (inner_w - tw) / 2.0
+    text_y = inner_y + (ribbon_h - size_ribbon) / 2.0 + 0.7*mm
+    texts.append((text_x, text_y, size_ribbon, ribbon_text))
+
+    # 3) Данные — ниже ленты
+    ty = inner_y - 2*mm - size_data
+
+    avg_char_w = 0.52 * size_data
+    max_chars = max(16, int((inner_w) / avg_char_w))
+    for text, kind in lines:
+        if kind != "data":
+            continue
+        # переносим только то, что не влезает: TextWrapper на каждую строку не нужен
+        if len(text) <= max_chars:
+            wrapped_lines = (text,)
+        else:
+            wrapped_lines = textwrap.wrap(text, width=max_chars)
+        for wrapped in wrapped_lines:
+            texts.append((inner_x, ty, size_data, wrapped))
+            ty -= (size_data + line_gap)
+            if ty < y + 3 * mm:
+                break
+
+    subsets, encoded = _encode_runs([t[3] for t in texts])
+    for (tx, ty, size, _), runs in zip(texts, encoded):
+        ops.append(_text_ops(tx, ty, size, runs))
+    ops.append("Q")
+    return "\n".join(ops).encode("ascii"), subsets
+
+@functools.lru_cache(maxsize=256)
+def _font_program(subset: tuple) -> bytes:
+    return _FACE.makeSubset(list(subset))
+
+def _add_font(pdf: pikepdf.Pdf, subset: tuple) -> pikepdf.Object:
+    """Шрифт-подмножество (simple TrueType, как у ReportLab) как объект документа pdf."""
+    if _FACE is None:
+        return pdf.make_indirect(pikepdf.Dictionary(
+            Type=pikepdf.Name.Font, Subtype=pikepdf.Name.Type1,
+            BaseFont=pikepdf.Name.Helvetica, Encoding=pikepdf.Name.WinAnsiEncoding))
+    digest = hashlib.md5(repr(subset).encode()).digest()
+    base_name = "".join(chr(65 + x % 26) for x in digest[:6]) + "+" + _FACE.name.decode("latin-1")
+    program = _font_program(subset)
+    font_file = pikepdf.Stream(pdf, program)
+    font_file.Length1 = len(program)
+    to_unicode = pikepdf.Stream(pdf, makeToUnicodeCMap(base_name, subset).encode("ascii"))
+    descriptor = pikepdf.Dictionary(
+        Type=pikepdf.Name.FontDescriptor,
+        FontName=pikepdf.Name("/" + base_name),
+        Flags=(_FACE.flags & ~32) | 4,   # symbolic: своя кодировка подмножества
+        FontBBox=pikepdf.Array(_FACE.bbox),
+        ItalicAngle=_FACE.italicAngle, Ascent=_FACE.ascent, Descent=_FACE.descent,
+        CapHeight=_FACE.capHeight, StemV=_FACE.stemV, MissingWidth=_FACE.defaultWidth,
+        FontFile2=pdf.make_indirect(font_file),
+    )
+    return pdf.make_indirect(pikepdf.Dictionary(
+        Type=pikepdf.Name.Font, Subtype=pikepdf.Name.TrueType,
+        BaseFont=pikepdf.Name("/" + base_name),
+        FirstChar=0, LastChar=len(subset) - 1,
+        Widths=pikepdf.Array([_FACE.getCharWidth(c) for c in subset]),
+        ToUnicode=pdf.make_indirect(to_unicode),
+        FontDescriptor=pdf.make_indirect(descriptor),
+    ))
+
+def overlay_stamp(pdf_path: str, lines: list[tuple[str,str]], pages="last", box_height_mm=28, font_size=9) -> str:
+    """Ставит штамп; возвращает путь к временному PDF-файлу (удаляет вызывающий)."""
+    lines = tuple(lines)
+    # по пути pikepdf сам отображает файл в память (mmap) — без копии в bytes
+    with pikepdf.Pdf.open(pdf_path) as pdf:
+        if pages == "first":
+            targets = pdf.pages[:1]
+        elif pages == "last":
+            targets = pdf.pages[-1:]
+        else:
+            targets = pdf.pages
+
+        # остальные страницы не трогаем: pikepdf читает их лениво и пишет как есть;
+        # штамп — Form XObject, шрифты встраиваются в документ один раз
+        fonts, forms = {}, {}
+        for page in targets:
+            mb = page.mediabox
+            w = float(mb[2]) - float(mb[0])
+            h = float(mb[3]) - float(mb[1])
+            # qpdf ставит форму вертикально относительно /Rotate (с учётом наследования);
+            # для 90/270 рисуем её в размерах развёрнутой страницы — тогда после поворота
+            # она ровно ложится в (0, 0, w, h) без масштаба, штамп внизу справа как на экране
+            fw, fh = (h, w) if page.rotation in (90, 270) else (w, h)
+            if (fw, fh) not in forms:
+                content, subsets = _render_overlay(fw, lines, box_height_mm, font_size)
+                for subset in subsets:
+                    if subset not in fonts:
+                        fonts[subset] = _add_font(pdf, subset)
+                form = pikepdf.Stream(pdf, content)
+                form.Type = pikepdf.Name.XObject
+                form.Subtype = pikepdf.Name.Form
+                form.BBox = pikepdf.Array([0, 0, fw, fh])
+                form.Resources = pikepdf.Dictionary(Font=pikepdf.Dictionary(
+                    {f"/F{n}": fonts[subset] for n, subset in enumerate(subsets)}))
+                forms[(fw, fh)] = pdf.make_indirect(form)
+            page.add_overlay(forms[(fw, fh)], pikepdf.Rectangle(0, 0, w, h))
+
+        with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as fout:
+            try:
+                pdf.save(fout, fix_metadata_version=False)
+            except Exception:
+                os.unlink(fout.name)
+                raise
+        return fout.name
+
+def stamp_file(pdf_path: str, sig_path: str, pages="last", box_height_mm=28, font_size=9) -> str:
+    """Проверка подписи + штамп одним вызовом (одна передача в пул процессов)."""
+    info = try_verify_and_extract(pdf_path, sig_path)
+    lines = build_stamp_lines(info)
+    return overlay_stamp(pdf_path, lines, pages=pages, box_height_mm=box_height_mm, font_size=font_size)
 
 # ---- HTTP ----
+async def _save_upload(upload: UploadFile, dst) -> None:
+    """Копируем загрузку во временный файл кусками по 1 МБ, не собирая её целиком в памяти."""
+    while chunk := await upload.read(1 << 20):
+        dst.write(chunk)
+
 @app.get("/", response_class=HTMLResponse)
 def index():
     return """
@@ -326,10 +614,10 @@ def index():
 @app.post("/verify")
 async def verify(sig: UploadFile = File(...), pdf: UploadFile = File(...)):
     with tempfile.NamedTemporaryFile(delete=False) as fpdf, tempfile.NamedTemporaryFile(delete=False) as fsig:
-        fpdf.write(await pdf.read()); fsig.write(await sig.read())
+        await _save_upload(pdf, fpdf); await _save_upload(sig, fsig)
         pdf_path, sig_path = fpdf.name, fsig.name
     try:
-        info = try_verify_and_extract(pdf_path, sig_path)
+        info = await _in_pool(try_verify_and_extract, pdf_path, sig_path)
         return JSONResponse(info)
     finally:
         os.unlink(pdf_path); os.unlink(sig_path)
@@ -342,15 +630,13 @@ async def stamp(sig: UploadFile = File(...),
                 font_size: int = Form(9)):
     if pages not in ("all", "first", "last"):
         raise HTTPException(400, "pages must be one of: all|first|last")
-    pdf_bytes = await pdf.read()
     with tempfile.NamedTemporaryFile(delete=False) as fpdf, tempfile.NamedTemporaryFile(delete=False) as fsig:
-        fpdf.write(pdf_bytes); fsig.write(await sig.read())
+        await _save_upload(pdf, fpdf); await _save_upload(sig, fsig)
         pdf_path, sig_path = fpdf.name, fsig.name
     try:
-        info = try_verify_and_extract(pdf_path, sig_path)
-        lines = build_stamp_lines(info)
-        stamped = overlay_stamp(pdf_bytes, lines, pages=pages, box_height_mm=box_height_mm, font_size=font_size)
-        return StreamingResponse(BytesIO(stamped), media_type="application/pdf",
-                                 headers={"Content-Disposition": 'attachment; filename="stamped.pdf"'})
+        out_path = await _in_pool(stamp_file, pdf_path, sig_path, pages, box_height_mm, font_size)
+        # отдаём файлом (sendfile), временный файл удаляем после отправки
+        return FileResponse(out_path, media_type="application/pdf", filename="stamped.pdf",
+                            background=BackgroundTask(os.unlink, out_path))
     finally:
         os.unlink(pdf_path); os.unlink(sig_path)